@@ -30,18 +30,19 @@ import base64
 import csv
 import ctypes
 import datetime
-import json
-import re
 import sys
 from getpass import getpass
 import secrets
 import string
 from ykman.device import list_all_devices
 import struct
-from time import sleep
+from time import monotonic, sleep
+from types import MappingProxyType
 
+import orjson
 import requests
 import urllib3
+from requests.adapters import HTTPAdapter
 from fido2.client import Fido2Client, UserInteraction, WindowsClient
 from fido2.ctap2.extensions import CredProtectExtension
 from fido2.hid import CtapHidDevice
@@ -61,14 +62,42 @@ from fido2.pcsc import SW_SUCCESS
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 requests.packages.urllib3.disable_warnings()
 
+# Share one session so the HTTPS connections to login.microsoftonline.com
+# and graph.microsoft.com are reused for every user in the batch.
+SESSION = requests.Session()
+SESSION.verify = False
+SESSION.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=4))
 
 in_csv_file_name = "./usersToRegister.csv"
 out_csv_file_name = "./keysRegistered.csv"
 config_file_name = "configs.json"
 pin = ""
 
+# Graph access token and when it was acquired, see get_access_token()
+graph_token = ""
+graph_token_acquired_at = 0.0
+graph_token_expires_in = 0
+
 with open(config_file_name, "r", encoding="utf8") as f:
-    configs = json.load(f)
+    configs = MappingProxyType(orjson.loads(f.read()))
+
+SET_RANDOM_PIN = configs["setRandomPIN"]
+SET_MIN_PIN = configs["setMinimumPINLength"]
+SET_FORCE_CHANGE = configs["setForceChangePin"]
+MIN_PIN_LEN = configs["minimumPINLength"]
+RAND_PIN_LEN = configs["randomPINLength"]
+TENANT = configs["tenantName"]
+CLIENT_ID = configs["client_id"]
+CLIENT_SECRET = configs["client_secret"]
+DEVICE_POLL_INTERVAL = configs.get("devicePollIntervalInSeconds", 0.2)
+DEVICE_WAIT_TIMEOUT = configs.get("deviceWaitTimeoutInSeconds", 300)
+
+
+# Platform checks don't change while the script runs
+_IS_WIN = WindowsClient.is_available()
+_IS_ADMIN = bool(ctypes.windll.shell32.IsUserAnAdmin()) if _IS_WIN else False
+# Use the Windows WebAuthn API if available, and we're not running as admin
+_USE_WIN_CLIENT = _IS_WIN and not _IS_ADMIN
 
 
 try:
@@ -89,14 +118,17 @@ def wait_device():
     print(">>> Waiting for Security Key to be plugged in...")
     return wait_device_loop()
 
-def wait_device_loop():
-    devices = list(enumerate_devices())
-    if( len(devices) == 0):
-        sleep(0.2)
-        return wait_device_loop()
-    if( len(devices) > 1):
-        raise Exception("More than one device found.")
-    return devices[0]
+def wait_device_loop(poll=DEVICE_POLL_INTERVAL, timeout=DEVICE_WAIT_TIMEOUT):
+    deadline = monotonic() + timeout
+    while True:
+        devices = list(enumerate_devices())
+        if len(devices) > 1:
+            raise Exception("More than one device found.")
+        if devices:
+            return devices[0]
+        if monotonic() > deadline:
+            raise TimeoutError("No security key detected")
+        sleep(poll)
 
 # Handle user interaction
 class CliInteraction(UserInteraction):    
@@ -104,7 +136,7 @@ class CliInteraction(UserInteraction):
         print("\nTouch your security key now...\n")
 
     def request_pin(self, permissions, rp_id):
-        if not configs["setRandomPIN"]:
+        if not SET_RANDOM_PIN:
             return getpass("Enter PIN: ")            
         else:
             return pin
@@ -114,11 +146,10 @@ class CliInteraction(UserInteraction):
         return True
 
 
-def base64url_to_bytearray(b64url_string):
-    temp = b64url_string.replace("_", "/").replace("-", "+")
-    return bytearray(
-        base64.urlsafe_b64decode(temp + "=" * (4 - len(temp) % 4))
-    )
+def base64url_to_bytes(b64url_string):
+    # urlsafe_b64decode handles the url-safe alphabet, only padding is needed
+    pad = -len(b64url_string) % 4
+    return base64.urlsafe_b64decode(b64url_string + "=" * pad)
 
 
 def create_credentials_on_security_key(
@@ -133,10 +164,7 @@ def create_credentials_on_security_key(
     device = wait_device()
     serial_number = get_serial_number(device)
 
-    if (
-        WindowsClient.is_available()
-        and not ctypes.windll.shell32.IsUserAnAdmin()
-    ):
+    if _USE_WIN_CLIENT:
         # Use the Windows WebAuthn API if available, and we're not running        
         client = WindowsClient("https://" + rp_id)
 
@@ -179,14 +207,12 @@ def create_credentials_on_security_key(
     print(f"\ncredentialId: {credential_id}")
 
     client_extenstion_results = websafe_encode(
-        json.dumps(result.attestation_object.auth_data.extensions).encode(
-            "utf-8"
-        )
+        orjson.dumps(result.attestation_object.auth_data.extensions)
     )
     print(f"\nclientExtensions: {websafe_decode(client_extenstion_results)}")
 
     # Set min pin length and force pin change flags
-    if configs["setMinimumPINLength"] or configs["setForceChangePin"]:
+    if SET_MIN_PIN or SET_FORCE_CHANGE:
         set_ctap21_flags(device)
 
     return (
@@ -198,60 +224,68 @@ def create_credentials_on_security_key(
     )
 
 
+_BASE_HEADERS = {
+    "Accept": "application/json",
+    "Content-Type": "application/json",
+    "Accept-Encoding": "gzip, deflate, br",
+}
+
+
 def set_http_headers(access_token):
-    return {
-        "Accept": "application/json",
-        "Authorization": access_token,
-        "Content-Type": "application/json",
-        "Accept-Encoding": "gzip, deflate, br",
-    }
+    return {**_BASE_HEADERS, "Authorization": access_token}
+
+
+# Most of the creation options are static and shouldn't change for each
+# user and for each request so this script staticly defines the creation
+# options that are retrieved from Microsoft Graph. Ideally these would
+# be retrieved directly from Microsoft Graph in case they do change.
+# They are built once here and shared, make_credential doesn't modify them.
+
+# Note about overriding the value for credentialProtectionPolicy.
+# The fido2 library only supports setting the credProtect extension
+# using the enum not the string value. OPTIONAL is equivalent
+# to "userVerificationOptional" which is also equivalent to "Level 1"
+
+# Note at the time of writing this, webauthn.dll does not set
+# credprotect extensions. Run in admin mode if credprotect
+# extensions must be set for your scenario and for your
+# fido2 security keys. The default behavior of YubiKeys is to
+# use credprotect level 1 if not explicitly set, the default value
+# aligns with the what Microsoft Graph expects to be used.
+# If credprotect > 1 is used on a security key, you should expect
+# Windows 10 desktop login scenarios to fail.
+_STATIC_EXT = {
+    "hmacCreateSecret": True,
+    "enforceCredentialProtectionPolicy": True,
+    "credentialProtectionPolicy": CredProtectExtension.POLICY.OPTIONAL,
+}
+_STATIC_PUBKEY_PARAMS = (
+    {"type": "public-key", "alg": -7},
+    {"type": "public-key", "alg": -257},
+)
+_STATIC_AUTH_SEL = {
+    "authenticatorAttachment": "cross-platform",
+    "requireResidentKey": True,
+    "userVerification": "required",
+}
 
 
 def build_creation_options(challenge, userId, displayName, name, rp_id):
-    # Most of the creation options are static and shouldn't change for each
-    # user and for each request so this script staticly defines the creation
-    # options that are retrieved from Microsoft Graph. Ideally these would
-    # be retrieved directly from Microsoft Graph in case they do change.
-
-    # Note about overriding the value for credentialProtectionPolicy.
-    # The fido2 library only supports setting the credProtect extension
-    # using the enum not the string value. OPTIONAL is equivalent
-    # to "userVerificationOptional" which is also equivalent to "Level 1"
-
-    # Note at the time of writing this, webauthn.dll does not set
-    # credprotect extensions. Run in admin mode if credprotect
-    # extensions must be set for your scenario and for your
-    # fido2 security keys. The default behavior of YubiKeys is to
-    # use credprotect level 1 if not explicitly set, the default value
-    # aligns with the what Microsoft Graph expects to be used.
-    # If credprotect > 1 is used on a security key, you should expect
-    # Windows 10 desktop login scenarios to fail.    
     public_key_credential_creation_options = {
         "publicKey": {
-            "challenge": base64url_to_bytearray(challenge),
+            "challenge": base64url_to_bytes(challenge),
             "timeout": 0,
             "attestation": "direct",
             "rp": {"id": rp_id, "name": "Microsoft"},
             "user": {
-                "id": base64url_to_bytearray(userId),
+                "id": base64url_to_bytes(userId),
                 "displayName": displayName,
                 "name": name,
             },
-            "pubKeyCredParams": [
-                {"type": "public-key", "alg": -7},
-                {"type": "public-key", "alg": -257},
-            ],
+            "pubKeyCredParams": _STATIC_PUBKEY_PARAMS,
             "excludeCredentials": [],
-            "authenticatorSelection": {
-                "authenticatorAttachment": "cross-platform",
-                "requireResidentKey": True,
-                "userVerification": "required",
-            },
-            "extensions": {
-                "hmacCreateSecret": True,
-                "enforceCredentialProtectionPolicy": True,
-                "credentialProtectionPolicy": CredProtectExtension.POLICY.OPTIONAL,
-            },
+            "authenticatorSelection": _STATIC_AUTH_SEL,
+            "extensions": _STATIC_EXT,
         }
     }
 
@@ -266,33 +300,49 @@ def get_access_token_for_microsoft_graph():
     headers = {"Content-Type": "application/x-www-form-urlencoded"}
     token_endpoint = (
         "https://login.microsoftonline.com/"
-        + configs["tenantName"]
+        + TENANT
         + "/oauth2/v2.0/token"
     )
 
     body = {
         "grant_type": "client_credentials",
-        "client_id": configs["client_id"],
-        "client_secret": configs["client_secret"],
+        "client_id": CLIENT_ID,
+        "client_secret": CLIENT_SECRET,
         "scope": "https://graph.microsoft.com/.default",
     }
 
-    token_response = requests.post(
-        token_endpoint, data=body, headers=headers, verify=False
-    )
-
-    access_token = re.search(
-        '"access_token":"([^"]+)"', str(token_response.content)
-    )
+    token_response = SESSION.post(token_endpoint, data=body, headers=headers)
 
-    decoded_response = json.loads(token_response.content)
+    decoded_response = orjson.loads(token_response.content)
     if "error" in decoded_response.keys():
         raise Exception(
             decoded_response["error"], decoded_response["error_description"]
         )
 
     print("\t retrieved access token using app credentials")
-    return access_token.group(1)
+    return (
+        decoded_response["access_token"],
+        int(decoded_response["expires_in"]),
+    )
+
+
+def get_access_token():
+    # Reuse the cached token until a minute before it expires so long
+    # bulk runs don't fail part way through with an expired token
+    global graph_token, graph_token_acquired_at, graph_token_expires_in
+    if (
+        graph_token
+        and monotonic() - graph_token_acquired_at
+        < graph_token_expires_in - 60
+    ):
+        return graph_token
+
+    acquired_at = monotonic()
+    graph_token, graph_token_expires_in = (
+        get_access_token_for_microsoft_graph()
+    )
+    graph_token_acquired_at = acquired_at
+    return graph_token
 
 
 # Call the Microsoft Graph to create a fido2method
@@ -323,8 +373,8 @@ def create_and_activate_fido_method(
                 "attestationObject": attestation,
                 "clientDataJSON": client_data,
             },
-            "clientExtensionResults": json.loads(
-                base64.b64decode(str(client_extensions)).decode("utf-8")
+            "clientExtensionResults": orjson.loads(
+                websafe_decode(client_extensions)
             ),
         },
         "displayName": "Serial: "
@@ -333,8 +383,8 @@ def create_and_activate_fido_method(
         + str(datetime.date.today()),
     }
 
-    response = requests.post(
-        fido_credentials_endpoint, json=body, headers=headers, verify=False
+    response = SESSION.post(
+        fido_credentials_endpoint, json=body, headers=headers
     )
 
     if response.status_code == 201:
@@ -348,8 +398,8 @@ def create_and_activate_fido_method(
         return False, []
 
 
-def generate_pin():
-    disallowed_pins = [
+_DISALLOWED_PINS = frozenset(
+    {
         "12345678",
         "12341234",
         "87654321",
@@ -365,15 +415,18 @@ def generate_pin():
         "520520",
         "123654",
         "159753",
-    ]
+    }
+)
+
 
+def generate_pin():
     # Get length
-    length = configs["randomPINLength"]
+    length = RAND_PIN_LEN
 
     while True:
         digits = "".join(secrets.choice(string.digits) for _ in range(length))
         # Check if PIN is not trivial and not in banned list
-        if len(set(digits)) != 1 and digits not in disallowed_pins:
+        if digits != digits[0] * length and digits not in _DISALLOWED_PINS:
             return digits
 
 
@@ -381,7 +434,7 @@ def generate_and_set_pin(device):
     print("-----")
     print("in generate_and_set_pin\n")
     global pin
-    if configs["setRandomPIN"]:
+    if SET_RANDOM_PIN:
         ctap = Ctap2(device)
         if ctap.info.options.get("clientPin"):
             print("\tPIN already set for the device. Quitting.")
@@ -401,12 +454,9 @@ def generate_and_set_pin(device):
 def set_ctap21_flags(device):
     global pin    
     #No need to try if using the Windows client (as non-admin)
-    if not (
-        WindowsClient.is_available()
-        and not ctypes.windll.shell32.IsUserAnAdmin()
-    ):
+    if not _USE_WIN_CLIENT:
         
-        if not configs['setRandomPIN']:
+        if not SET_RANDOM_PIN:
             #Need to prompt for PIN again if using user supplied PIN
             print("PIN required to set minimum length and force pin change flags")
             pin = getpass("Please enter the PIN:")
@@ -421,13 +471,13 @@ def set_ctap21_flags(device):
             config = Config(ctap, client_pin.protocol, token)
 
             # Set PIN length
-            if configs["setMinimumPINLength"]:
-                length = configs["minimumPINLength"]
+            if SET_MIN_PIN:
+                length = MIN_PIN_LEN
                 print("\tGoing to set the minimum pin length to " + str(length) + ".")
                 config.set_min_pin_length(min_pin_length=length)
             
             # Set Force Change PIN
-            if configs["setForceChangePin"]:
+            if SET_FORCE_CHANGE:
                 print("\tGoing to force a PIN change on first use.")
                 config.set_min_pin_length(force_change_pin=True)
     else:
@@ -436,20 +486,44 @@ def set_ctap21_flags(device):
         )
 
 
+YUBICO_VID = 0x1050
+
+
+def is_possible_yubikey(device):
+    # ykman only lists USB attached YubiKeys, so NFC devices are never
+    # matched and go straight to the Thales lookup
+    if isinstance(device, CtapHidDevice):
+        return device.descriptor.vid == YUBICO_VID
+    return False
+
+
 def get_serial_number(device):
     # Get serial number for YubiKey
-    for device, info in list_all_devices():
-        print(f"\tFound YubiKey with serial number: {info.serial}")
-        return info.serial
+    # wait_device_loop only allows a single connected security key, so the
+    # first YubiKey found is the one being registered
+    if is_possible_yubikey(device):
+        for _, info in list_all_devices():
+            print(f"\tFound YubiKey with serial number: {info.serial}")
+            return info.serial
     # Get serial number for Thales Security Key
     return get_thales_serial_number(device)
 
 
+# Thales vendor command (0x50) reading the serial over CTAPHID, sent after
+# the 4 byte channel id
+_THALES_HID_SERIAL_CMD = struct.pack(">BBBB", 128 | 0x50, 0x00, 0x01, 0x55)
+# Card Manager applet selection used to read the serial over NFC
+_AID_CM = b"\xa0\x00\x00\x00\x03\x00\x00\x00"
+_THALES_APDU_SELECT = (
+    b"\x00\xa4\x04\x00" + struct.pack("!B", len(_AID_CM)) + _AID_CM
+)
+
+
 def get_thales_serial_number(device) -> string:
         
     if isinstance(device, CtapHidDevice):
         # Get Thales Serial Number in USB mode
-        packet = struct.pack(">IBBBB", device._channel_id, 128 | 0x50, 0x00, 0x01, 0x55)
+        packet = struct.pack(">I", device._channel_id) + _THALES_HID_SERIAL_CMD
         device._connection.write_packet(packet.ljust(device._packet_size, b"\0"))        
         recv = device._connection.read_packet()
 
@@ -457,20 +531,18 @@ def get_thales_serial_number(device) -> string:
         if r_channel != device._channel_id:
             raise Exception("Wrong channel")
         
+        if len(recv) < 17:
+            raise Exception("Unable to get Thales Serial Number")
+        
         if (recv[7] != 0) or (recv[8] != 0x02): 
             raise Exception("Unable to get Thales Serial Number")    
         
-        if sys.getsizeof(recv) < 17:
-            raise Exception("Unable to get Thales Serial Number")
-        
         serial = recv[9:17].decode("utf-8")
     
     else:
         # Get Thales Serial Number in NFC mode
         try:
-            AID_CM = b"\xa0\x00\x00\x00\x03\x00\x00\x00"
-            apdu = b"\x00\xa4\x04\x00" + struct.pack("!B", len(AID_CM)) + AID_CM
-            resp, sw1, sw2 = device.apdu_exchange(apdu)
+            resp, sw1, sw2 = device.apdu_exchange(_THALES_APDU_SELECT)
             if (sw1, sw2) != SW_SUCCESS:
                 raise Exception("Card Manager applet selection failure.")
 
@@ -491,25 +563,25 @@ def get_thales_serial_number(device) -> string:
 def warn_user_about_pin_behaviors():
     # See BulkRegistration.md for more details
     # Windows configurations to look out for:
-    if WindowsClient.is_available():
+    if _IS_WIN:
         # Running on Windows as admin
-        if ctypes.windll.shell32.IsUserAnAdmin():
-            if not configs["setRandomPIN"]:
+        if _IS_ADMIN:
+            if not SET_RANDOM_PIN:
                 print(
                     "\n\n\tIf PIN is not already set on security key(s), "
                     "then make sure PIN is set on security keys before "
                     "proceeding"
                 )
                 input("\n\tPress Enter key to continue...")
-            if configs["setRandomPIN"]:
+            if SET_RANDOM_PIN:
                 print(
                     "\n\n\tIf PIN is already set on security key(s) then "
                     "script will prompt for existing PIN and change to new "
                     "random PIN."
                 )
                 input("\n\tPress Enter key to continue...")
-        if not ctypes.windll.shell32.IsUserAnAdmin():
-            if configs["setRandomPIN"]:
+        if not _IS_ADMIN:
+            if SET_RANDOM_PIN:
                 print(
                     "\n\n\tsetRandomPIN setting is set to true. This "
                     "setting will be ignored. User will be prompted to "
@@ -517,15 +589,15 @@ def warn_user_about_pin_behaviors():
                 )
                 input("\n\tPress Enter key to continue...")
     # macOS and other platforms configurations to look out for:
-    if not WindowsClient.is_available():
-        if not configs["setRandomPIN"]:
+    if not _IS_WIN:
+        if not SET_RANDOM_PIN:
             print(
                 "\n\n\tIf PIN is not already set on security key(s), "
                 "then make sure PIN is set on security keys before "
                 "proceeding"
             )
             input("\n\tPress Enter key to continue...")
-        if configs["setRandomPIN"]:
+        if SET_RANDOM_PIN:
             print(
                 "\n\n\tIf PIN is already set on security key(s) then "
                 "script will prompt for existing PIN and change to new "
@@ -536,8 +608,8 @@ def warn_user_about_pin_behaviors():
 
 def main():
     warn_user_about_pin_behaviors()
-    access_token = get_access_token_for_microsoft_graph()
-    line_count = 0
+    # Fail fast on bad app credentials before touching any security key
+    get_access_token()
     with open(in_csv_file_name, newline="") as in_csv_file:
         with open(out_csv_file_name, "w", newline="") as out_csv_file:
             csv_reader = csv.reader(in_csv_file)
@@ -546,17 +618,22 @@ def main():
             csv_writer.writerow(
                 ["#upn", "entraIDAuthMethodObjectId", "serialNumber", "PIN"]
             )
+            # Assume header exists in the csv and skip this row
+            next(csv_reader, None)
+            print("\tSkip csv header row")
             for row in csv_reader:
-                if line_count == 0:
-                    # Assume header exists in the csv and skip this row
-                    print("\tSkip csv header row")
-                else:
-                    user_name = row[0]
-                    user_display_name = row[1]
-                    user_id = row[2]
-                    challenge = row[3]
-                    challenge_expiry_time = row[4]
-                    rp_id = row[5]
+                try:
+                    # Refresh the token before the key is modified so a
+                    # failure can't leave an unrecorded credential and PIN
+                    access_token = get_access_token()
+                    (
+                        user_name,
+                        user_display_name,
+                        user_id,
+                        challenge,
+                        challenge_expiry_time,
+                        rp_id,
+                    ) = row[:6]
                     print("-------------------------------------------------")
                     print(f"\tprocessing user: {user_name}")
                     print("-------------------------------------------------")
@@ -565,42 +642,41 @@ def main():
                     print(f"\tchallengeExpiryTime: {challenge_expiry_time}")
                     print(f"\trpID: {rp_id}")
                     print("\n")
-                    try:
-                        (
-                            att,
-                            clientData,
-                            credId,
-                            extn,
-                            serial,
-                        ) = create_credentials_on_security_key(
-                            user_id, challenge, user_display_name, user_name,rp_id
-                        )
-                        activated, auth_method = create_and_activate_fido_method(
-                            credId,
-                            extn,
-                            user_name,
-                            att,
-                            clientData,
-                            serial,
-                            access_token,
-                        )
-                    except Exception as error:
-                        print("\n\tERROR >> " + str(error))
-                        print("\tERROR >> Exiting\n")
-                        return
-
-                    print(
-                        "\n\tCompleted registration and configuration "
-                        + f"for user: {user_name}"
+                    (
+                        att,
+                        clientData,
+                        credId,
+                        extn,
+                        serial,
+                    ) = create_credentials_on_security_key(
+                        user_id, challenge, user_display_name, user_name,rp_id
+                    )
+                    activated, auth_method = create_and_activate_fido_method(
+                        credId,
+                        extn,
+                        user_name,
+                        att,
+                        clientData,
+                        serial,
+                        access_token,
                     )
+                except Exception as error:
+                    print("\n\tERROR >> " + str(error))
+                    print("\tERROR >> Exiting\n")
+                    return
 
-                    # Write CSV with security key registration details
-                    # username,authMethodID,serialNumber,PIN
-                    csv_writer.writerow([user_name, auth_method, serial, pin])
-                    input("\tPress Enter key to continue...")
-                    print("-----")
+                print(
+                    "\n\tCompleted registration and configuration "
+                    + f"for user: {user_name}"
+                )
 
-                line_count += 1
+                # Write CSV with security key registration details
+                # username,authMethodID,serialNumber,PIN
+                csv_writer.writerow([user_name, auth_method, serial, pin])
+                # Flush each row so a PIN isn't lost if the run is aborted
+                out_csv_file.flush()
+                input("\tPress Enter key to continue...")
+                print("-----")
     print(
         "\nAfter verifying results, cleanup any csv files"
         + " that are no longer needed.\n"